@@ -3,6 +3,15 @@
 It requires a free api key which needs to be set in the
 environment variable "ALPHAVANTAGE_API_KEY"
 
+Latest prices are cached in memory for 60 seconds by default; this can be
+changed by setting the environment variable "ALPHAVANTAGE_CACHE_TTL" to a
+number of seconds.
+
+Requests share a pool of 16 connections, and Source.get_prices_bulk() fetches
+with 8 threads by default. These can be changed by setting the environment
+variables "ALPHAVANTAGE_POOL_SIZE" and "ALPHAVANTAGE_MAX_WORKERS". Keep the pool
+at least as large as the number of workers.
+
 Valid tickers for prices are in the form "price:XXX:YYY", such as "price:IBM:USD"
 where XXX is the symbol and YYY is the expected quote currency in which the data
 is returned. The api currently does not support converting to a specific ccy and
@@ -24,24 +33,59 @@ https://www.alphavantage.co/query?function=CURRENCY_EXCHANGE_RATE&from_currency=
 
 from decimal import Decimal
 
+import bisect
 import logging
 import re
+import threading
+from concurrent import futures
 from os import environ
-from time import sleep
+from time import monotonic, sleep
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from dateutil.tz import tz
-from dateutil.parser import parse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from beanprice import source
 
+_loads: Callable[[bytes], Any]
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    import json
+
+    _loads = json.loads
+
 
 class AlphavantageApiError(ValueError):
     "An error from the Alphavantage API."
 
 
+class AlphavantageRateLimitError(AlphavantageApiError):
+    "The Alphavantage API refused a request because of a rate limit."
+
+
+# The fixed formats of dates and timestamps in API responses.
+_DATE_FORMAT = "%Y-%m-%d"
+_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Stock quotes are dated in UTC, and so are nearly all exchange rates.
+_TZUTC = tz.tzutc()
+_TIMEZONES = {"UTC": _TZUTC}
+
+
+def _gettz(name):
+    """Return the timezone for a name, short-circuiting the common ones."""
+    return _TIMEZONES.get(name) or tz.gettz(name)
+
+
+_TICKER_RE = re.compile(r"^(price|fx):([^:]+):(\w+)$")
+
+
 def _parse_ticker(ticker):
     """Parse the base and quote currencies from the ticker.
 
@@ -50,26 +94,239 @@ def _parse_ticker(ticker):
     Returns:
       A (kind, symbol, base) tuple.
     """
-    match = re.match(r"^(?P<kind>price|fx):(?P<symbol>[^:]+):(?P<base>\w+)$", ticker)
+    match = _TICKER_RE.match(ticker)
     if not match:
         raise ValueError('Invalid ticker. Use "price:SYMBOL:BASE" or "fx:CCY:BASE" format.')
     return match.groups()
 
 
-def _do_fetch(params):
-    params["apikey"] = environ["ALPHAVANTAGE_API_KEY"]
+class _RateLimiter:
+    """A thread-safe token bucket spacing out requests to the API.
+
+    Callers reserve a token under the lock and sleep outside of it, so that
+    concurrent workers queue up behind each other instead of bursting past the
+    limit.
+    """
 
-    resp = requests.get(url="https://www.alphavantage.co/query", params=params)
-    data = resp.json()
-    # This is for dealing with the rate limit, sleep for 60 seconds and then retry
+    def __init__(self, calls, period):
+        self._lock = threading.Lock()
+        self._capacity = float(calls)
+        self._rate = calls / period
+        self.reset()
+
+    def reset(self):
+        """Refill the bucket, forgetting all past requests."""
+        self._tokens = self._capacity
+        self._last = monotonic()
+
+    def acquire(self):
+        """Block until a request may be issued."""
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self._capacity, self._tokens + (now - self._last) * self._rate
+            )
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait > 0:
+            sleep(wait)
+
+
+# Premium API keys are allowed 75 requests per minute.
+_RATE_LIMITER = _RateLimiter(75, 60.0)
+
+
+# The maximum number of symbols requested in a single batch quote.
+_BATCH_SIZE = 100
+
+# Set once the batch endpoint turns out to be unavailable for the API key, so
+# later calls go straight to one request per ticker.
+_BATCH_UNAVAILABLE = False
+
+
+def _env_number(name, default, convert, minimum):
+    """Read a number from the environment, falling back to a default.
+
+    Args:
+      name: A string, the name of the environment variable.
+      default: The value to use if the variable is unset or invalid.
+      convert: A callable converting the string value, e.g. int or float.
+      minimum: The smallest acceptable value.
+    Returns:
+      The converted value of the variable, or `default`.
+    """
+    value = environ.get(name)
+    if value is None:
+        return default
+    try:
+        number = convert(value)
+    except ValueError:
+        number = None
+    # Written as a negation so that NaN is rejected too.
+    if number is None or not number >= minimum:
+        logging.warning("Ignoring invalid %s=%r; using %s", name, value, default)
+        return default
+    return number
+
+
+# Latest quotes barely move within a minute, so they are reused for this many
+# seconds. Historical prices of past days never change and are kept for the
+# whole process.
+# Sources are instantiated for every job, so the caches live at module level.
+_CACHE_TTL = _env_number("ALPHAVANTAGE_CACHE_TTL", 60.0, float, 0)
+_CACHE_LOCK = threading.Lock()
+_LATEST_CACHE: Dict[str, Tuple[float, source.SourcePrice]] = {}
+_HISTORICAL_CACHE: Dict[Tuple[str, str], source.SourcePrice] = {}
+_SERIES_CACHE: Dict[Tuple[str, str], Tuple[str, Dict, List[str]]] = {}
+
+
+def _cached_latest_price(ticker):
+    """Return the cached latest price of a ticker if still fresh, or None."""
+    with _CACHE_LOCK:
+        cached = _LATEST_CACHE.get(ticker)
+    if cached is not None and monotonic() - cached[0] < _CACHE_TTL:
+        return cached[1]
+    return None
+
+
+def _reset_cache():
+    """Drop all cached prices and API state and refill the request budget."""
+    global _BATCH_UNAVAILABLE
+    _BATCH_UNAVAILABLE = False
+    with _CACHE_LOCK:
+        _LATEST_CACHE.clear()
+        _HISTORICAL_CACHE.clear()
+        _SERIES_CACHE.clear()
+    _RATE_LIMITER.reset()
+
+
+# Delays in seconds before each attempt when the API reports a rate limit.
+_RETRY_DELAYS = (0, 2, 5, 15, 60)
+
+
+# The monotonic time before which no thread should issue a request, because
+# the API reported a rate limit.
+_RATE_LIMITED_UNTIL = 0.0
+_RATE_LIMITED_LOCK = threading.Lock()
+
+
+def _hold_off(seconds):
+    """Make every thread wait at least `seconds` before its next request."""
+    global _RATE_LIMITED_UNTIL
+    with _RATE_LIMITED_LOCK:
+        _RATE_LIMITED_UNTIL = max(_RATE_LIMITED_UNTIL, monotonic() + seconds)
+
+
+def _wait_for_hold_off():
+    """Block until requests may be issued after a rate limit."""
+    with _RATE_LIMITED_LOCK:
+        remaining = _RATE_LIMITED_UNTIL - monotonic()
+    if remaining > 0:
+        sleep(remaining)
+
+
+# The wording of the notice sent once the daily request quota is used up, e.g.
+# "Our standard API rate limit is 25 requests per day."
+_DAILY_LIMIT_RE = re.compile(r"rate limit is \d+ requests per day", re.IGNORECASE)
+
+# The wordings of notices about short bursts of requests, which pass if we wait.
+_BURST_LIMIT_WORDS = ("spreading out", "per second", "per minute")
+
+
+def _is_rate_limited(data):
+    """Return true if the decoded response is a short-term rate limit notice."""
+    if not isinstance(data, dict):
+        return False
     if "Note" in data:
-        sleep(60)
-        resp = requests.get(url="https://www.alphavantage.co/query", params=params)
-        data = resp.json()
+        return True
+    information = data.get("Information", "").lower()
+    return any(words in information for words in _BURST_LIMIT_WORDS)
+
+
+def _is_daily_limit(data):
+    """Return true if the decoded response reports an exhausted daily quota.
+
+    Burst notices also mention the daily quota, so check _is_rate_limited()
+    first. Premium notices are neither and are left to the caller.
+    """
+    if not isinstance(data, dict):
+        return False
+    return bool(_DAILY_LIMIT_RE.search(data.get("Information", "")))
+
+
+def _make_session(pool_size):
+    """Create a session whose connection pool can serve `pool_size` workers.
 
-    if resp.status_code != requests.codes.ok:
-        raise AlphavantageApiError(
-            "Invalid response ({}): {}".format(resp.status_code, resp.text)
+    Transient transport errors and server errors are retried by the adapter;
+    rate limit notices in the response body are handled by _do_fetch().
+    """
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+def _find_trading_day(dates, target):
+    """Find the latest date on or before a target date.
+
+    Args:
+      dates: A sorted list of ISO date strings. ISO dates sort as strings.
+      target: An ISO date string.
+    Returns:
+      The latest date of `dates` not after `target`, or None if there is none.
+    """
+    index = bisect.bisect_right(dates, target)
+    return dates[index - 1] if index else None
+
+
+# A shared session, so that the connection to the API is kept alive across
+# requests and threads.
+_POOL_SIZE = _env_number("ALPHAVANTAGE_POOL_SIZE", 16, int, 1)
+_SESSION = _make_session(_POOL_SIZE)
+
+# The default number of threads used by Source.get_prices_bulk().
+_MAX_WORKERS = _env_number("ALPHAVANTAGE_MAX_WORKERS", 8, int, 1)
+
+
+def _do_fetch(params):
+    params["apikey"] = environ["ALPHAVANTAGE_API_KEY"]
+
+    # This is for dealing with the rate limit, back off and retry a few times.
+    # The back off is shared, so concurrent fetches hold off along with us.
+    for delay in _RETRY_DELAYS:
+        if delay:
+            _hold_off(delay)
+        _wait_for_hold_off()
+        _RATE_LIMITER.acquire()
+        resp = _SESSION.get(
+            url="https://www.alphavantage.co/query", params=params, timeout=30
+        )
+        # Server errors that outlasted the adapter's retries carry an HTML body.
+        if resp.status_code != requests.codes.ok:
+            raise AlphavantageApiError(
+                "Invalid response ({}): {}".format(resp.status_code, resp.text)
+            )
+        data = _loads(resp.content)
+        if _is_rate_limited(data):
+            continue
+        # Waiting does not help once the daily quota is used up.
+        if _is_daily_limit(data):
+            raise AlphavantageRateLimitError(
+                "Daily request quota exhausted: {}".format(data["Information"])
+            )
+        break
+    else:
+        raise AlphavantageRateLimitError(
+            "Rate limit exceeded: {}".format(data.get("Note") or data.get("Information"))
         )
 
     if "Error Message" in data:
@@ -78,41 +335,185 @@ def _do_fetch(params):
     return data
 
 
+def _is_endpoint_unavailable(message):
+    """Return true if an API message says a function is missing or premium-only."""
+    message = message.lower()
+    return "premium" in message or "function" in message
+
+
+def _get_section(data, key):
+    """Return a section of a decoded response.
+
+    Raises:
+      AlphavantageApiError: If the section is missing, with the notice the API
+        returned instead, such as a premium endpoint message.
+    """
+    if isinstance(data, dict) and key in data:
+        return data[key]
+    notice = repr(data)
+    if isinstance(data, dict):
+        notice = data.get("Information") or data.get("Note") or notice
+    raise AlphavantageApiError("Invalid response, missing {!r}: {}".format(key, notice))
+
+
+def _parse_global_quote(data):
+    """Extract the price and its date from a GLOBAL_QUOTE response."""
+    quote = _get_section(data, "Global Quote")
+    date = datetime.strptime(quote["07. latest trading day"], _DATE_FORMAT)
+    return Decimal(quote["05. price"]), date.replace(tzinfo=_TZUTC)
+
+
+def _parse_exchange_rate(data):
+    """Extract the rate and its time from a CURRENCY_EXCHANGE_RATE response."""
+    rate = _get_section(data, "Realtime Currency Exchange Rate")
+    date = datetime.strptime(rate["6. Last Refreshed"], _DATETIME_FORMAT)
+    date = date.replace(tzinfo=_gettz(rate["7. Time Zone"]))
+    return Decimal(rate["5. Exchange Rate"]), date
+
+
 class Source(source.Source):
     def get_latest_price(self, ticker):
         kind, symbol, base = _parse_ticker(ticker)
 
+        cached = _cached_latest_price(ticker)
+        if cached is not None:
+            return cached
+
         if kind == "price":
             params = {
                 "function": "GLOBAL_QUOTE",
                 "symbol": symbol,
             }
-            data = _do_fetch(params)
-
-            price_data = data["Global Quote"]
-            price = Decimal(price_data["05. price"])
-            date = parse(price_data["07. latest trading day"]).replace(tzinfo=tz.tzutc())
+            price, date = _parse_global_quote(_do_fetch(params))
         else:
             params = {
                 "function": "CURRENCY_EXCHANGE_RATE",
                 "from_currency": symbol,
                 "to_currency": base,
             }
-            data = _do_fetch(params)
-
-            price_data = data["Realtime Currency Exchange Rate"]
-            price = Decimal(price_data["5. Exchange Rate"])
-            date = parse(price_data["6. Last Refreshed"]).replace(
-                tzinfo=tz.gettz(price_data["7. Time Zone"])
-            )
+            price, date = _parse_exchange_rate(_do_fetch(params))
+
+        srcprice = source.SourcePrice(price, date, base)
+        with _CACHE_LOCK:
+            _LATEST_CACHE[ticker] = (monotonic(), srcprice)
+        return srcprice
+
+    def get_prices_bulk(
+        self, tickers: List[str], max_workers: Optional[int] = None
+    ) -> List[source.SourcePrice]:
+        """Fetch the latest prices of many tickers concurrently.
+
+        The requests are I/O bound, so they are dispatched on a pool of threads
+        sharing the module's connection pool. Requests are still throttled to
+        the API's rate limit.
+
+        Args:
+          tickers: A list of tickers, in the format accepted by get_latest_price().
+          max_workers: The maximum number of requests in flight at once. Defaults
+            to ALPHAVANTAGE_MAX_WORKERS, or 8.
+        Returns:
+          A list of SourcePrice instances, in the same order as `tickers`.
+        """
+        if max_workers is None:
+            max_workers = _MAX_WORKERS
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.get_latest_price, tickers))
+
+    def get_latest_prices_batch(
+        self, tickers: List[str]
+    ) -> Dict[str, source.SourcePrice]:
+        """Fetch the latest prices of many tickers with as few requests as possible.
+
+        Stock tickers are grouped into BATCH_STOCK_QUOTES requests of up to
+        _BATCH_SIZE symbols each. If the batch endpoint is unavailable for the
+        API key, or a symbol is missing from its response, this falls back to
+        one GLOBAL_QUOTE request per ticker; an unavailable endpoint is
+        remembered and not tried again. Exchange rates are always fetched
+        individually. Tickers whose latest price is still cached are not
+        requested again, and rate limit errors are raised, not retried per
+        ticker.
+
+        Args:
+          tickers: A list of tickers, in the format accepted by get_latest_price().
+        Returns:
+          A dict of ticker to SourcePrice instance.
+        """
+        global _BATCH_UNAVAILABLE
+        prices = {}
+        by_symbol: Dict[str, List[Tuple[str, str]]] = {}
+        for ticker in tickers:
+            kind, symbol, base = _parse_ticker(ticker)
+            cached = _cached_latest_price(ticker)
+            if cached is not None:
+                prices[ticker] = cached
+            elif kind == "price":
+                by_symbol.setdefault(symbol, []).append((ticker, base))
+            else:
+                prices[ticker] = self.get_latest_price(ticker)
 
-        return source.SourcePrice(price, date, base)
+        symbols = [] if _BATCH_UNAVAILABLE else list(by_symbol)
+        for index in range(0, len(symbols), _BATCH_SIZE):
+            chunk = symbols[index : index + _BATCH_SIZE]
+            params = {
+                "function": "BATCH_STOCK_QUOTES",
+                "symbols": ",".join(chunk),
+            }
+            try:
+                data = _do_fetch(params)
+            except AlphavantageRateLimitError:
+                # Falling back to one request per ticker would only make it worse.
+                raise
+            except AlphavantageApiError as exc:
+                if not _is_endpoint_unavailable(str(exc)):
+                    raise
+                logging.info("Batch quotes unavailable: %s", exc)
+                _BATCH_UNAVAILABLE = True
+                break
+            if "Information" in data:
+                logging.info("Batch quotes unavailable: %s", data["Information"])
+                _BATCH_UNAVAILABLE = True
+                break
+
+            for item in data.get("Stock Quotes", []):
+                price = Decimal(item["2. price"])
+                # Keep only the trading day, like GLOBAL_QUOTE, so cached prices
+                # have the same shape whichever request fetched them.
+                date = datetime.strptime(item["4. timestamp"][:10], _DATE_FORMAT)
+                date = date.replace(tzinfo=_TZUTC)
+                for ticker, base in by_symbol.get(item["1. symbol"], []):
+                    prices[ticker] = source.SourcePrice(price, date, base)
+                    with _CACHE_LOCK:
+                        _LATEST_CACHE[ticker] = (monotonic(), prices[ticker])
+
+        for ticker_bases in by_symbol.values():
+            for ticker, _ in ticker_bases:
+                if ticker not in prices:
+                    prices[ticker] = self.get_latest_price(ticker)
+
+        return prices
 
     def get_historical_price(
         self, ticker, time: datetime
     ) -> Optional[source.SourcePrice]:
         kind, symbol, base = _parse_ticker(ticker)
 
+        # The requested day is formatted once, and used both as the cache key
+        # and to search the series.
+        target = time.strftime(_DATE_FORMAT)
+        cache_key = (ticker, target)
+        # Today is taken in the timezone of the query, like the target, and used
+        # by both caches so that they agree on when a day rolls over.
+        today = datetime.now(time.tzinfo).strftime(_DATE_FORMAT)
+        # Today's bar is intraday until the close is posted, and until then a
+        # query for today falls back to an earlier day, so only past days are
+        # served from or stored in the caches.
+        settled = target < today
+        if settled:
+            with _CACHE_LOCK:
+                cached = _HISTORICAL_CACHE.get(cache_key)
+            if cached is not None:
+                return cached
+
         # Compact is default and returns 100 data points.  So use "full" if we need more.
         # Due to weekends the data actually goes back just under 5 months (~150 days) so
         # this could be optimized more.
@@ -128,24 +529,45 @@ class Source(source.Source):
                 "outputSize": param_output_size
             }
 
-            data = _do_fetch(params)
+            # The whole series is kept for the day, so that backfilling many dates
+            # of the same symbol only makes a single request. It is replaced by the
+            # first request made on a later day.
+            series_key = (symbol, param_output_size)
+            with _CACHE_LOCK:
+                cached_series = _SERIES_CACHE.get(series_key)
+            if settled and cached_series is not None and cached_series[0] == today:
+                _, data, dates = cached_series
+            else:
+                data = _do_fetch(params)
+                dates = sorted(data.get("Time Series (Daily)", ()))
+                with _CACHE_LOCK:
+                    _SERIES_CACHE[series_key] = (today, data, dates)
 
-            if "Information" in data and "premium endpoint" in data["Information"].lower():
+            if "Information" in data and "premium" in data["Information"].lower():
                 logging.info("Premium endpoint API key required.")
                 return None
             else:
                 if "Time Series (Daily)" in data:
                     price_data = data["Time Series (Daily)"]
 
-                    # If this day has price data use it, otherwise go backwards until one is
-                    # found.
-                    while time.strftime("%Y-%m-%d") not in price_data:
-                        time -= timedelta(days=1)
-
-                    day_data = price_data[time.strftime("%Y-%m-%d")]
+                    # If this day has price data use it, otherwise use the latest day
+                    # before it.
+                    found = _find_trading_day(dates, target)
+                    if found is None:
+                        logging.info("No price data on or before %s", target)
+                        return None
+                    if found != target:
+                        gap = datetime.fromisoformat(target) - datetime.fromisoformat(found)
+                        time -= gap
+
+                    day_data = price_data[found]
                     price = Decimal(day_data["4. close"])
 
-                    return source.SourcePrice(price, time, base)
+                    srcprice = source.SourcePrice(price, time, base)
+                    if settled:
+                        with _CACHE_LOCK:
+                            _HISTORICAL_CACHE[cache_key] = srcprice
+                    return srcprice
                 else:
                     logging.error("Price data not found when expected: %s", repr(data))
                     return None
@@ -1,4 +1,5 @@
 import datetime
+import json
 import unittest
 from os import environ
 from decimal import Decimal
@@ -68,18 +69,27 @@ response_tsda = {
     }
 }
 
-def response(contents, status_code=requests.codes.ok):
-    """Return a context manager to patch a JSON response."""
+def mock_response(contents, status_code=requests.codes.ok):
+    """Return a mock response with the given JSON contents."""
     response = mock.Mock()
     response.status_code = status_code
     response.text = ""
-    response.json.return_value = contents
-    return mock.patch("requests.get", return_value=response)
+    response.content = json.dumps(contents).encode()
+    return response
+
+
+def response(contents, status_code=requests.codes.ok):
+    """Return a context manager to patch a JSON response."""
+    return mock.patch.object(
+        alphavantage._SESSION, "get", return_value=mock_response(contents, status_code)
+    )
 
 
 class AlphavantagePriceFetcher(unittest.TestCase):
     def setUp(self):
         environ["ALPHAVANTAGE_API_KEY"] = "foo"
+        alphavantage._reset_cache()
+        alphavantage._RATE_LIMITED_UNTIL = 0.0
 
     def tearDown(self):
         del environ["ALPHAVANTAGE_API_KEY"]
@@ -98,6 +108,20 @@ class AlphavantagePriceFetcher(unittest.TestCase):
             )
             self.assertEqual("USD", srcprice.quote_currency)
 
+    def test_get_historical_price_weekend(self):
+        with response(contents=response_tsda):
+            srcprice = alphavantage.Source().get_historical_price(
+                "price:IBM:USD", datetime.datetime(2025, 4, 6).replace(tzinfo=timezone)
+            )
+            self.assertEqual(Decimal("227.48"), srcprice.price)
+            self.assertEqual(datetime.date(2025, 4, 4), srcprice.time.date())
+
+    def test_get_historical_price_before_data(self):
+        with response(contents=response_tsda):
+            srcprice = alphavantage.Source().get_historical_price(
+                "price:IBM:USD", datetime.datetime(2025, 4, 1).replace(tzinfo=timezone)
+            )
+            self.assertIsNone(srcprice)
 
     def test_error_invalid_ticker(self):
         with self.assertRaises(ValueError):
@@ -108,12 +132,132 @@ class AlphavantagePriceFetcher(unittest.TestCase):
             with self.assertRaises(alphavantage.AlphavantageApiError):
                 alphavantage.Source().get_latest_price("price:IBM:USD")
 
+    def test_error_server_html(self):
+        resp = mock_response(None, 503)
+        resp.content = b"<html><body>Service Unavailable</body></html>"
+        with mock.patch.object(alphavantage._SESSION, "get", return_value=resp):
+            with self.assertRaises(alphavantage.AlphavantageApiError):
+                alphavantage.Source().get_latest_price("price:IBM:USD")
+
     def test_error_response(self):
         contents = {"Error Message": "Something wrong"}
         with response(contents):
             with self.assertRaises(alphavantage.AlphavantageApiError):
                 alphavantage.Source().get_latest_price("price:IBM:USD")
 
+    def test_error_notice(self):
+        contents = {"Information": "This is a premium endpoint."}
+        with response(contents):
+            with self.assertRaisesRegex(
+                alphavantage.AlphavantageApiError, "premium endpoint"
+            ):
+                alphavantage.Source().get_latest_price("price:IBM:USD")
+            with self.assertRaisesRegex(
+                alphavantage.AlphavantageApiError, "premium endpoint"
+            ):
+                alphavantage.Source().get_latest_price("fx:USD:CHF")
+
+    @mock.patch("beanprice.sources.alphavantage.sleep")
+    def test_rate_limit_retry(self, mock_sleep):
+        note = mock_response({"Note": "Thank you for using Alpha Vantage!"})
+        quote = mock_response(
+            {
+                "Global Quote": {
+                    "05. price": "144.7400",
+                    "07. latest trading day": "2021-01-21",
+                }
+            }
+        )
+        responses = [note, note, quote]
+        with mock.patch.object(alphavantage._SESSION, "get", side_effect=responses):
+            srcprice = alphavantage.Source().get_latest_price("price:IBM:USD")
+        self.assertEqual(Decimal("144.7400"), srcprice.price)
+        delays = [args[0] for args, _ in mock_sleep.call_args_list]
+        self.assertEqual(2, len(delays))
+        self.assertAlmostEqual(2, delays[0], places=1)
+        self.assertAlmostEqual(5, delays[1], places=1)
+
+    @mock.patch("beanprice.sources.alphavantage.sleep")
+    def test_rate_limit_shared(self, mock_sleep):
+        contents = {
+            "Global Quote": {
+                "05. price": "144.7400",
+                "07. latest trading day": "2021-01-21",
+            }
+        }
+        alphavantage._hold_off(60)
+        with response(contents):
+            alphavantage.Source().get_latest_price("price:IBM:USD")
+        mock_sleep.assert_called_once()
+        self.assertAlmostEqual(60, mock_sleep.call_args[0][0], places=1)
+
+    @mock.patch("beanprice.sources.alphavantage.sleep")
+    def test_error_rate_limit(self, _):
+        contents = {
+            "Information": "Please consider spreading out your free API requests "
+            "more sparingly (5 requests per minute)."
+        }
+        with response(contents) as mock_get:
+            with self.assertRaises(alphavantage.AlphavantageRateLimitError):
+                alphavantage.Source().get_latest_price("price:IBM:USD")
+            self.assertEqual(5, mock_get.call_count)
+
+    @mock.patch("beanprice.sources.alphavantage.sleep")
+    def test_error_daily_limit(self, mock_sleep):
+        contents = {
+            "Information": "Thank you for using Alpha Vantage! Our standard API rate "
+            "limit is 25 requests per day. Please subscribe to any of the premium "
+            "plans at https://www.alphavantage.co/premium/ to instantly remove all "
+            "daily rate limits."
+        }
+        time = datetime.datetime(2025, 4, 4)
+        with response(contents) as mock_get:
+            with self.assertRaises(alphavantage.AlphavantageRateLimitError):
+                alphavantage.Source().get_historical_price("price:IBM:USD", time)
+            self.assertEqual(1, mock_get.call_count)
+        mock_sleep.assert_not_called()
+
+    @mock.patch("beanprice.sources.alphavantage.sleep")
+    def test_premium_output_size(self, mock_sleep):
+        contents = {
+            "Information": "Thank you for using Alpha Vantage! The **outputsize=full** "
+            "parameter value is a premium feature for the TIME_SERIES_DAILY endpoint. "
+            "You may subscribe to any of the premium plans at "
+            "https://www.alphavantage.co/premium/ to instantly unlock all premium "
+            "features"
+        }
+        time = datetime.datetime(2020, 1, 2)
+        with response(contents) as mock_get:
+            srcprice = alphavantage.Source().get_historical_price("price:IBM:USD", time)
+            self.assertEqual(1, mock_get.call_count)
+        self.assertIsNone(srcprice)
+        mock_sleep.assert_not_called()
+
+    @mock.patch("beanprice.sources.alphavantage.sleep")
+    def test_burst_limit_retry(self, mock_sleep):
+        burst = mock_response(
+            {
+                "Information": "Thank you for using Alpha Vantage! Please consider "
+                "spreading out your free API requests more sparingly (1 request per "
+                "second). You may subscribe to any of the premium plans at "
+                "https://www.alphavantage.co/premium/ to lift the free key rate limit "
+                "(25 requests per day) and instantly unlock all premium features"
+            }
+        )
+        quote = mock_response(
+            {
+                "Global Quote": {
+                    "05. price": "144.7400",
+                    "07. latest trading day": "2021-01-21",
+                }
+            }
+        )
+        responses = [burst, quote]
+        with mock.patch.object(alphavantage._SESSION, "get", side_effect=responses):
+            srcprice = alphavantage.Source().get_latest_price("price:IBM:USD")
+        self.assertEqual(Decimal("144.7400"), srcprice.price)
+        self.assertEqual(1, mock_sleep.call_count)
+
     def test_valid_response_price(self):
         contents = {
             "Global Quote": {
@@ -147,6 +291,207 @@ class AlphavantagePriceFetcher(unittest.TestCase):
                 datetime.datetime(2021, 2, 21, 20, 32, 25, tzinfo=tz.tzutc()), srcprice.time
             )
 
+    def test_latest_price_cached(self):
+        contents = {
+            "Global Quote": {
+                "05. price": "144.7400",
+                "07. latest trading day": "2021-01-21",
+            }
+        }
+        with response(contents) as mock_get:
+            first = alphavantage.Source().get_latest_price("price:FOO:USD")
+            second = alphavantage.Source().get_latest_price("price:FOO:USD")
+            self.assertEqual(first, second)
+            self.assertEqual(1, mock_get.call_count)
+
+    def test_historical_price_cached(self):
+        time = datetime.datetime(2025, 4, 4).replace(tzinfo=timezone)
+        with response(contents=response_tsda) as mock_get:
+            first = alphavantage.Source().get_historical_price("price:IBM:USD", time)
+            second = alphavantage.Source().get_historical_price("price:IBM:USD", time)
+            self.assertEqual(first, second)
+            self.assertEqual(1, mock_get.call_count)
+
+    def test_get_latest_prices_batch(self):
+        contents = {
+            "Meta Data": {
+                "1. Information": "Batch Stock Market Quotes",
+                "2. Notes": "IEX Real-Time",
+                "3. Time Zone": "US/Eastern",
+            },
+            "Stock Quotes": [
+                {
+                    "1. symbol": "IBM",
+                    "2. price": "144.7400",
+                    "3. volume": "--",
+                    "4. timestamp": "2021-01-21 15:59:59",
+                },
+                {
+                    "1. symbol": "MSFT",
+                    "2. price": "224.9700",
+                    "3. volume": "--",
+                    "4. timestamp": "2021-01-21 15:59:58",
+                },
+            ],
+        }
+        with response(contents) as mock_get:
+            srcprices = alphavantage.Source().get_latest_prices_batch(
+                ["price:IBM:USD", "price:MSFT:USD"]
+            )
+            self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(Decimal("144.7400"), srcprices["price:IBM:USD"].price)
+        self.assertEqual(Decimal("224.9700"), srcprices["price:MSFT:USD"].price)
+        self.assertEqual(
+            datetime.datetime(2021, 1, 21, tzinfo=tz.tzutc()),
+            srcprices["price:IBM:USD"].time,
+        )
+
+    def test_get_latest_prices_batch_fallback(self):
+        batch = mock_response({"Information": "This is a premium endpoint."})
+        contents = {
+            "Global Quote": {
+                "05. price": "144.7400",
+                "07. latest trading day": "2021-01-21",
+            }
+        }
+        quote = mock_response(contents)
+        with mock.patch.object(alphavantage._SESSION, "get", side_effect=[batch, quote]):
+            srcprices = alphavantage.Source().get_latest_prices_batch(["price:IBM:USD"])
+        self.assertEqual(Decimal("144.7400"), srcprices["price:IBM:USD"].price)
+
+        # The batch endpoint is not tried again.
+        with response(contents) as mock_get:
+            alphavantage.Source().get_latest_prices_batch(["price:MSFT:USD"])
+            self.assertEqual(1, mock_get.call_count)
+            self.assertEqual("GLOBAL_QUOTE", mock_get.call_args[1]["params"]["function"])
+
+    def test_historical_price_today_not_cached(self):
+        # Today's close is not posted yet, so yesterday's is returned. Once it is
+        # posted, a new query for today must see it.
+        now = datetime.datetime.now()
+        today = now.strftime("%Y-%m-%d")
+        yesterday = (now - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        before_close = {"Time Series (Daily)": {yesterday: {"4. close": "100.00"}}}
+        after_close = {
+            "Time Series (Daily)": {
+                yesterday: {"4. close": "100.00"},
+                today: {"4. close": "200.00"},
+            }
+        }
+        with response(before_close):
+            srcprice = alphavantage.Source().get_historical_price("price:IBM:USD", now)
+            self.assertEqual(Decimal("100.00"), srcprice.price)
+        with response(after_close) as mock_get:
+            srcprice = alphavantage.Source().get_historical_price("price:IBM:USD", now)
+            self.assertEqual(Decimal("200.00"), srcprice.price)
+            # Today's bar is still intraday, so it is fetched again.
+            alphavantage.Source().get_historical_price("price:IBM:USD", now)
+            self.assertEqual(2, mock_get.call_count)
+
+    def test_historical_series_cached(self):
+        with response(contents=response_tsda) as mock_get:
+            for day in (3, 4, 7):
+                time = datetime.datetime(2025, 4, day).replace(tzinfo=timezone)
+                alphavantage.Source().get_historical_price("price:IBM:USD", time)
+            self.assertEqual(1, mock_get.call_count)
+
+    def test_env_number(self):
+        with mock.patch.dict(environ, {"ALPHAVANTAGE_CACHE_TTL": "30"}):
+            self.assertEqual(
+                30.0, alphavantage._env_number("ALPHAVANTAGE_CACHE_TTL", 60.0, float, 0)
+            )
+        for value in ("abc", "-1", "nan"):
+            with mock.patch.dict(environ, {"ALPHAVANTAGE_CACHE_TTL": value}):
+                with self.assertLogs(level="WARNING"):
+                    self.assertEqual(
+                        60.0,
+                        alphavantage._env_number("ALPHAVANTAGE_CACHE_TTL", 60.0, float, 0),
+                    )
+
+    def test_get_latest_prices_batch_missing_function(self):
+        batch = mock_response(
+            {"Error Message": "This API function (BATCH_STOCK_QUOTES) does not exist."}
+        )
+        quote = mock_response(
+            {
+                "Global Quote": {
+                    "05. price": "144.7400",
+                    "07. latest trading day": "2021-01-21",
+                }
+            }
+        )
+        responses = [batch, quote]
+        with mock.patch.object(alphavantage._SESSION, "get", side_effect=responses):
+            srcprices = alphavantage.Source().get_latest_prices_batch(["price:IBM:USD"])
+        self.assertEqual(Decimal("144.7400"), srcprices["price:IBM:USD"].price)
+
+    def test_get_latest_prices_batch_rate_limit(self):
+        contents = {"Information": "Our standard API rate limit is 25 requests per day."}
+        with response(contents) as mock_get:
+            with self.assertRaises(alphavantage.AlphavantageRateLimitError):
+                alphavantage.Source().get_latest_prices_batch(
+                    ["price:IBM:USD", "price:MSFT:USD"]
+                )
+            self.assertEqual(1, mock_get.call_count)
+
+    def test_get_latest_prices_batch_cached(self):
+        contents = {
+            "Global Quote": {
+                "05. price": "144.7400",
+                "07. latest trading day": "2021-01-21",
+            }
+        }
+        with response(contents):
+            cached = alphavantage.Source().get_latest_price("price:IBM:USD")
+        with response({}) as mock_get:
+            srcprices = alphavantage.Source().get_latest_prices_batch(["price:IBM:USD"])
+            mock_get.assert_not_called()
+        self.assertEqual(cached, srcprices["price:IBM:USD"])
+
+    def test_historical_series_replaced_next_day(self):
+        alphavantage._SERIES_CACHE[("IBM", "full")] = ("2000-01-01", {}, [])
+        with response(contents=response_tsda) as mock_get:
+            time = datetime.datetime(2025, 4, 4)
+            alphavantage.Source().get_historical_price("price:IBM:USD", time)
+            self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(1, len(alphavantage._SERIES_CACHE))
+        self.assertNotEqual("2000-01-01", alphavantage._SERIES_CACHE[("IBM", "full")][0])
+
+    def test_env_number_workers(self):
+        for value in ("0", "-3", "2.5"):
+            with mock.patch.dict(environ, {"ALPHAVANTAGE_MAX_WORKERS": value}):
+                with self.assertLogs(level="WARNING"):
+                    self.assertEqual(
+                        8, alphavantage._env_number("ALPHAVANTAGE_MAX_WORKERS", 8, int, 1)
+                    )
+
+    def test_rate_limiter_reset(self):
+        limiter = alphavantage._RateLimiter(2, 60.0)
+        with mock.patch("beanprice.sources.alphavantage.sleep") as mock_sleep:
+            for _ in range(3):
+                limiter.acquire()
+            mock_sleep.assert_called_once()
+            limiter.reset()
+            limiter.acquire()
+            mock_sleep.assert_called_once()
+
+    def test_get_prices_bulk(self):
+        quotes = {
+            "IBM": {"05. price": "144.7400", "07. latest trading day": "2021-01-21"},
+            "MSFT": {"05. price": "224.9700", "07. latest trading day": "2021-01-21"},
+        }
+
+        def fake_get(url, params, timeout):
+            return mock_response({"Global Quote": quotes[params["symbol"]]})
+
+        with mock.patch.object(alphavantage._SESSION, "get", side_effect=fake_get):
+            srcprices = alphavantage.Source().get_prices_bulk(
+                ["price:IBM:USD", "price:MSFT:USD"], max_workers=2
+            )
+        self.assertEqual(
+            [Decimal("144.7400"), Decimal("224.9700")], [p.price for p in srcprices]
+        )
+
 
 if __name__ == "__main__":
     unittest.main()